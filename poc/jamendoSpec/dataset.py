@@ -2,6 +2,7 @@
 import os
 import numpy as np
 import pickle
+import torch
 from torch.utils import data
 from scripts import commons
 from torchvision import transforms
@@ -79,11 +80,14 @@ class AudioFolder(data.Dataset):
 
 
 
-def get_audio_loader(root, subset, batch_size, tr_val='train', split=0, num_workers=0):
+def get_audio_loader(root, subset, batch_size, tr_val='train', split=0, num_workers=0, pin_memory=None):
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
     data_loader = data.DataLoader(dataset=MyAudioFolder(root, subset, tr_val, split),
                                   batch_size=batch_size,
                                   shuffle=True,
-                                  num_workers=num_workers)
+                                  num_workers=num_workers,
+                                  pin_memory=pin_memory)
     tmp = MyAudioFolder(root, subset, tr_val, split)
     data_loader.tag_list = tmp.taglist
     return data_loader
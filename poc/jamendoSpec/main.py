@@ -12,6 +12,9 @@ def main(config):
     if not os.path.exists(config.model_save_path):
         os.makedirs(config.model_save_path)
 
+    if config.eval_batch_size is None:
+        config.eval_batch_size = config.batch_size * 4
+
     if config.mode == 'TRAIN':
         data_loader = get_audio_loader(config.audio_path,
                                        config.subset,
@@ -21,7 +24,7 @@ def main(config):
                                        num_workers=config.num_workers)
         valid_loader = get_audio_loader(config.audio_path,
                                         config.subset,
-                                        config.batch_size,
+                                        config.eval_batch_size,
                                         tr_val='validation',
                                         split = config.split,
                                         num_workers=config.num_workers)
@@ -33,7 +36,7 @@ def main(config):
     elif config.mode == 'TEST':
         data_loader = get_audio_loader(config.audio_path,
                                        config.subset,
-                                        config.batch_size,
+                                        config.eval_batch_size,
                                         tr_val = 'test',
                                         split = config.split)
 
@@ -46,6 +49,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--eval_batch_size', type=int, default=None, help='defaults to 4 * batch_size')
     parser.add_argument('--mode', type=str, default='TRAIN')
     parser.add_argument('--model_save_path', type=str, default='./models')
     parser.add_argument('--audio_path', type=str, default='/m/cs/work/falconr1/datasets/mtg-jamendo-dataset-master/')
@@ -54,6 +58,7 @@ if __name__ == '__main__':
     parser.add_argument('--subset', type=str, default='top50tags')
     parser.add_argument('--num_workers', type=int, default=0)
     parser.add_argument('--num_epochs', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help='print the per tag scores')
 
     config = parser.parse_args()
 
@@ -155,6 +155,6 @@ class CNN(nn.Module):
         # classifier
         x = x.view(x.size(0), -1)
         x = self.dropout(x)
-        logit = nn.Sigmoid()(self.dense(x))
+        logit = self.dense(x)  # the sigmoid is applied in the loss (BCEWithLogitsLoss)
 
         return logit
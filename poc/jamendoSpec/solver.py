@@ -7,13 +7,55 @@ import tqdm
 from sklearn import metrics
 import pickle
 import csv
-import math
+import concurrent.futures
 
 import torch
 import torch.nn as nn
 
 from model import CNN
 
+try:
+    from torchmetrics import MetricCollection
+    from torchmetrics.classification import MultilabelAUROC, MultilabelAveragePrecision
+except ImportError:
+    MetricCollection = None
+
+
+class CUDAPrefetcher(object):
+    """Copies the next batch to the GPU on a side stream while the current one is processed."""
+    def __init__(self, loader, to_var, is_cuda):
+        self.loader = iter(loader)
+        self.to_var = to_var
+        self.is_cuda = is_cuda
+        if self.is_cuda:
+            self.stream = torch.cuda.Stream()
+        self.preload()
+
+    def preload(self):
+        try:
+            self.next_x, self.next_y = next(self.loader)
+        except StopIteration:
+            self.next_x, self.next_y = None, None
+            return
+        if self.is_cuda:
+            with torch.cuda.stream(self.stream):
+                self.next_x = self.to_var(self.next_x)
+                self.next_y = self.to_var(self.next_y)
+        else:
+            self.next_x = self.to_var(self.next_x)
+            self.next_y = self.to_var(self.next_y)
+
+    def next(self):
+        if self.is_cuda:
+            torch.cuda.current_stream().wait_stream(self.stream)
+        x, y = self.next_x, self.next_y
+        if self.is_cuda and x is not None:
+            # tensors were allocated on the side stream, keep them alive for the current one
+            x.record_stream(torch.cuda.current_stream())
+            y.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return x, y
+
 
 class Solver(object):
     def __init__(self, data_loader, valid_loader, config, root):
@@ -25,9 +67,17 @@ class Solver(object):
         self.n_epochs = config.num_epochs
         self.lr = 1e-4
         self.log_step = 10
+        self._fmt = '[%s] Epoch [%d/%d] Iter [%d/%d] train loss: %.4f Elapsed: %.1fs'
+        self._valid_fmt = '[%s] Epoch [%d/%d], Iter [%d/%d] valid loss: %.4f Elapsed: %.1fs'
+        self._test_fmt = '[%s] Iter [%d/%d] test loss: %.4f Elapsed: %.1fs'
         self.is_cuda = torch.cuda.is_available()
+        self.device = torch.device('cuda' if self.is_cuda else 'cpu')
+        for loader in (self.data_loader, self.valid_loader):
+            if loader is not None and self.is_cuda and not loader.pin_memory:
+                print("WARNING, data loader without pin_memory, host to device copies will be synchronous.")
         self.model_save_path = config.model_save_path
         self.batch_size = config.batch_size
+        self.verbose = getattr(config, 'verbose', False)
         self.tag_list = self.get_tag_list(config, root)
         if config.subset == 'all':
             self.num_class = 183
@@ -56,19 +106,105 @@ class Solver(object):
         self.model = model
         if self.is_cuda:
             self.model.cuda()
-        self.optimizer = torch.optim.Adam(self.model.parameters(), self.lr)
+            # NHWC layout lets cudnn pick the tensor core convolution kernels
+            self.model = self.model.to(memory_format=torch.channels_last)
+        # uncompiled module, its state_dict keys are not prefixed with _orig_mod
+        self.base_model = self.model
+        if self.is_cuda and hasattr(torch, 'compile'):
+            # default mode, without cuda graphs: batch sizes and train/eval mode vary between loops
+            self.model = torch.compile(self.model)
+        self.optimizer = self.get_optimizer(torch.optim.Adam, self.lr)
+        # the model outputs logits, the sigmoid is fused into the loss
+        self.criterion = nn.BCEWithLogitsLoss()
+
+        # checkpoints are written to disk by a background thread, started by the first save_async
+        self._ckpt_executor = None
+        self._ckpt_future = None
+        # host copy of the best weights, restored by _schedule without reading the file back
+        self._best_sd = None
+        # mixed precision, both are no-ops when running on cpu
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.is_cuda)
+
+        # validation metrics, accumulated on the device when torchmetrics is available
+        # Both metrics keep the same preds/target states, the collection stores and updates them once.
+        # Targets are binary and preds already went through a sigmoid, validate_args would sync with the host.
+        self.auc_metrics = None
+        if MetricCollection is not None:
+            self.auc_metrics = MetricCollection({
+                'roc_auc': MultilabelAUROC(num_labels=self.num_class, average=None, validate_args=False),
+                'pr_auc': MultilabelAveragePrecision(num_labels=self.num_class, average=None, validate_args=False),
+            }, compute_groups=True)
+            if self.is_cuda:
+                self.auc_metrics.cuda()
+            print("Validation metrics: torchmetrics (on device)")
+        else:
+            print("Validation metrics: sklearn (torchmetrics not installed)")
+
+    def get_optimizer(self, optimizer_class, lr, **kwargs):
+        # Prefer the fused (single kernel) update, then the multi-tensor one. Older pytorch versions have neither.
+        options = [{'foreach': True}]
+        if self.is_cuda:
+            options.insert(0, {'fused': True})
+        for option in options:
+            try:
+                optimizer = optimizer_class(self.model.parameters(), lr, **option, **kwargs)
+            except TypeError:  # unknown keyword in this pytorch version
+                continue
+            print("Optimizer: %s (%s)" % (optimizer_class.__name__, list(option)[0]))
+            return optimizer
+        print("Optimizer: %s (plain)" % optimizer_class.__name__)
+        return optimizer_class(self.model.parameters(), lr, **kwargs)
 
     def load(self, filename):
+        self.wait_checkpoint()
         S = torch.load(filename)
-        self.model.load_state_dict(S)
+        self.base_model.load_state_dict(S)
 
     def save(self, filename):
-        model = self.model.state_dict()
+        model = self.base_model.state_dict()
         torch.save({'model': model}, filename)
 
+    def save_async(self, filename):
+        # Copy the weights to the host now, the write to disk overlaps with the next epoch
+        self.wait_checkpoint()
+        state = {k: v.detach().to('cpu', non_blocking=True) if v.is_cuda else v.detach().clone()
+                 for k, v in self.base_model.state_dict().items()}
+        copied = None
+        if self.is_cuda:
+            copied = torch.cuda.Event()
+            copied.record()
+        if self._ckpt_executor is None:
+            self._ckpt_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._ckpt_future = self._ckpt_executor.submit(self._write_checkpoint, state, filename, copied)
+        self._best_sd = state
+
+    def _write_checkpoint(self, state, filename, copied):
+        if copied is not None:
+            copied.synchronize()
+        # training keeps running, do not leave a partial best_model.pth behind if it crashes mid-write
+        torch.save(state, filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+
+    def _restore_best(self):
+        if self._best_sd is None:
+            self.load(os.path.join(self.model_save_path, 'best_model.pth'))
+        else:
+            # the pending write has waited for the non-blocking copies into the host copy
+            self.wait_checkpoint()
+            self.base_model.load_state_dict(self._best_sd)
+
+    def wait_checkpoint(self):
+        # Also raises any error from the background write
+        if self._ckpt_future is not None:
+            self._ckpt_future.result()
+            self._ckpt_future = None
+
     def to_var(self, x):
+        # non_blocking copies only overlap with compute if the loader uses pin_memory=True
         if self.is_cuda:
-            x = x.cuda()
+            x = x.cuda(non_blocking=True)
+            if x.dim() == 4:  # spectrograms are [batch, channel, freq, time]
+                x = x.to(memory_format=torch.channels_last)
         return x
 
     def train(self):
@@ -76,110 +212,115 @@ class Solver(object):
         current_optimizer = 'adam'
         best_roc_auc = 0
         drop_counter = 0
-        reconst_loss = nn.BCELoss()
-
-        # Variables to keep track of time
-        t_total = 0
-        t_epoch = 0
-        t_step = 0
-        last_time = time.time()
-        last_epoch = time.time()
-        all_time = []
-        all_time_epoch = []
-
-        for epoch in range(self.n_epochs):
-            t = time.time()
-            t_step = t - last_time
-            t_total += t_step
-            last_time = t
-            all_time.append(t_step)
-
-            drop_counter += 1
-            # train
-            self.model.train()
-            ctr = 0
-            for x, y in self.data_loader:
-                ctr += 1
-
-                # variables to cuda
-                x = self.to_var(x)
-                y = self.to_var(y)
-
-                # predict
-                out = self.model(x)
-                loss = reconst_loss(out, y)
-
-                # back propagation
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
-
-                # print log
-                if (ctr) % self.log_step == 0:
-                    print("[%s] Epoch [%d/%d] Iter [%d/%d] train loss: %.4f Elapsed: %s" %
-                            (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                            epoch+1, self.n_epochs, ctr, len(self.data_loader), loss.item(),
-                            datetime.timedelta(seconds=time.time()-start_t)))
-
-            # validation
-            roc_auc, _ = self._validation(start_t, epoch)
-
-            # save model
-            if roc_auc > best_roc_auc:
-                print('best model: %4f' % roc_auc)
-                best_roc_auc = roc_auc
-                torch.save(self.model.state_dict(), os.path.join(self.model_save_path, 'best_model.pth'))
-
-            # schedule optimizer
-            current_optimizer, drop_counter = self._schedule(current_optimizer, drop_counter)
-
-            t = time.time()
-            t_epoch = t - last_epoch
-            last_epoch = t
-            all_time_epoch.append(t_epoch)
 
-            print("---- Summary ----- Epoch [{}/{}], t_epoch = {:.4f}, t_total = {:.4f}".format(
-                epoch + 1, self.n_epochs, t_epoch, t_total
-            ))
+        try:
+            for epoch in range(self.n_epochs):
+                epoch_t = time.time()
+                drop_counter += 1
+                # train
+                self.model.train()
+                ctr = 0
+                prefetcher = CUDAPrefetcher(self.data_loader, self.to_var, self.is_cuda)
+                x, y = prefetcher.next()
+                while x is not None:
+                    ctr += 1
+
+                    # predict
+                    with torch.cuda.amp.autocast(enabled=self.is_cuda):
+                        out = self.model(x)
+                        loss = self.criterion(out, y)
+
+                    # back propagation
+                    self.optimizer.zero_grad(set_to_none=True)
+                    self.scaler.scale(loss).backward()
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+
+                    # print log
+                    # keep loss.item() and the time formatting inside this branch, item() syncs with the gpu
+                    if (ctr) % self.log_step == 0:
+                        print(self._fmt %
+                                (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                                epoch+1, self.n_epochs, ctr, len(self.data_loader), loss.item(),
+                                time.time()-start_t))
+
+                    x, y = prefetcher.next()
+
+                # validation
+                roc_auc, _ = self._validation(start_t, epoch)
+
+                # save model
+                if roc_auc > best_roc_auc:
+                    print('best model: %4f' % roc_auc)
+                    best_roc_auc = roc_auc
+                    self.save_async(os.path.join(self.model_save_path, 'best_model.pth'))
+
+                # schedule optimizer
+                current_optimizer, drop_counter = self._schedule(current_optimizer, drop_counter)
+
+                t = time.time()
+                print("---- Summary ----- Epoch [{}/{}], t_epoch = {:.4f}, t_total = {:.4f}".format(
+                    epoch + 1, self.n_epochs, t - epoch_t, t - start_t
+                ))
+        finally:
+            # surface errors from a pending background write, also when training fails
+            try:
+                self.wait_checkpoint()
+            finally:
+                if self._ckpt_executor is not None:
+                    self._ckpt_executor.shutdown()
+                    self._ckpt_executor = None
 
         print("[%s] Train finished. Elapsed: %s"
                 % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                     datetime.timedelta(seconds=time.time() - start_t)))
 
     def _validation(self, start_t, epoch):
-        prd_array = []  # prediction
-        gt_array = []   # ground truth
+        if self.auc_metrics is None:
+            prd_array = torch.empty((len(self.valid_loader.dataset), self.num_class), device=self.device)  # prediction
+            gt_array = torch.empty_like(prd_array)  # ground truth
+        offset = 0
+        pos_count = 0    # positives per tag
         ctr = 0
         self.model.eval()
-        reconst_loss = nn.BCELoss()
-        for x, y in self.valid_loader:
-            ctr += 1
-
-            # variables to cuda
-            x = self.to_var(x)
-            y = self.to_var(y)
-
-            # predict
-            out = self.model(x)
-            loss = reconst_loss(out, y)
-
-            # print log
-            if (ctr) % self.log_step == 0:
-                print("[%s] Epoch [%d/%d], Iter [%d/%d] valid loss: %.4f Elapsed: %s" %
-                        (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                        epoch+1, self.n_epochs, ctr, len(self.valid_loader), loss.item(),
-                        datetime.timedelta(seconds=time.time()-start_t)))
-
-            # append prediction
-            out = out.detach().cpu()
-            y = y.detach().cpu()
-            for prd in out:
-                prd_array.append(list(np.array(prd)))
-            for gt in y:
-                gt_array.append(list(np.array(gt)))
+        with torch.inference_mode():
+            prefetcher = CUDAPrefetcher(self.valid_loader, self.to_var, self.is_cuda)
+            x, y = prefetcher.next()
+            while x is not None:
+                ctr += 1
+
+                # predict
+                with torch.cuda.amp.autocast(enabled=self.is_cuda):
+                    out = self.model(x)
+                    loss = self.criterion(out, y)
+
+                # print log
+                if (ctr) % self.log_step == 0:
+                    print(self._valid_fmt %
+                            (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                            epoch+1, self.n_epochs, ctr, len(self.valid_loader), loss.item(),
+                            time.time()-start_t))
+
+                # append prediction
+                if self.auc_metrics is not None:
+                    out = torch.sigmoid(out.detach().float())
+                    y = y.detach()
+                    self.auc_metrics.update(out, y.int())
+                    pos_count = pos_count + y.sum(dim=0)
+                else:
+                    # logits stay on the device, copied to the host once after the loop
+                    bs = out.shape[0]
+                    prd_array[offset:offset+bs] = out.detach()
+                    gt_array[offset:offset+bs] = y.detach()
+                    offset += bs
+
+                x, y = prefetcher.next()
 
         # get auc
-        roc_auc, pr_auc, _, _ = self.get_auc_turbo(prd_array, gt_array, self.tag_list)
+        if self.auc_metrics is not None:
+            roc_auc, pr_auc = self.get_auc_metrics(pos_count)
+        else:
+            roc_auc, pr_auc, _, _ = self.get_auc_turbo(torch.sigmoid(prd_array[:offset].cpu()).numpy(), gt_array[:offset].cpu().numpy(), self.tag_list)
         return roc_auc, pr_auc
 
     def get_tag_list(self, config, root):
@@ -207,13 +348,37 @@ class Solver(object):
             print('%s \t\t %.4f , %.4f' % (self.tag_list[i], roc_auc_all[i], pr_auc_all[i]))
         return roc_aucs, pr_aucs, roc_auc_all, pr_auc_all
 
+    def get_auc_metrics(self, pos_count):
+        scores = self.auc_metrics.compute()
+        self.auc_metrics.reset()
+        roc_auc_all = scores['roc_auc']
+        pr_auc_all = scores['pr_auc']
+
+        # Same as get_auc_turbo, tags with count <= 0 are left out of the scores
+        cols = pos_count > 0
+        if not bool(cols.all()):
+            print("WARNING, {} columns removed from scores computation.".format(int((~cols).sum())))
+        roc_auc = roc_auc_all[cols].mean().item()
+        pr_auc = pr_auc_all[cols].mean().item()
+
+        print('roc_auc: %.4f' % roc_auc)
+        print('pr_auc: %.4f' % pr_auc)
+
+        if self.verbose:
+            print("")
+            print("Per tag, roc_auc, pr_auc")
+            fixed_labels_list = list(np.array(self.tag_list)[cols.cpu().numpy()])
+            for name, tag_roc_auc, tag_pr_auc in zip(fixed_labels_list, roc_auc_all[cols].tolist(), pr_auc_all[cols].tolist()):
+                print('%s \t\t\t %.4f \t%.4f' % (name, tag_roc_auc, tag_pr_auc))
+        return roc_auc, pr_auc
+
     def get_auc_turbo(self, y_preds, y_true, labels_list):
         print("===========================================")
         print("Scores")
         print("===========================================")
 
-        y_true = np.array(y_true)
-        y_preds = np.array(y_preds)
+        y_true = np.asarray(y_true)
+        y_preds = np.asarray(y_preds)
 
         print(y_true.sum(axis=0))
         print(y_true.shape)
@@ -232,56 +397,45 @@ class Solver(object):
         print(y_preds.shape)
 
         score_accuracy = 0
-        score_lwlrap = 0
         score_roc_auc = 0
         score_pr_auc = 0
-        score_mse = 0
         score_roc_auc_all = np.zeros((len(labels_list), 1))
         score_pr_auc_all = np.zeros((len(labels_list), 1))
         try:
             # for accuracy, lets pretend this is a single label problem, so assign only one label to every prediction
             score_accuracy = 0
-            score_lwlrap = metrics.label_ranking_average_precision_score(y_true, y_preds)
-            score_mse = math.sqrt(metrics.mean_squared_error(y_true, y_preds))
+            # These are per tag, the macro average is their mean
             # Average precision is a single number used to approximate the integral of the PR curve
-            score_pr_auc = metrics.average_precision_score(y_true, y_preds, average="macro")
-            score_roc_auc = metrics.roc_auc_score(y_true, y_preds, average="macro")
+            score_roc_auc_all = metrics.roc_auc_score(y_true, y_preds, average=None)
+            score_pr_auc_all = metrics.average_precision_score(y_true, y_preds, average=None)
+            score_roc_auc = float(np.nanmean(score_roc_auc_all))
+            score_pr_auc = float(np.nanmean(score_pr_auc_all))
         except ValueError as e:
             print("Soemthing wrong with evaluation")
             print(e)
         print("Accuracy =  %f" % (score_accuracy))
-        print("Label ranking average precision =  %f" % (score_lwlrap))
         print("ROC_AUC score  = %f" % (score_roc_auc))
         print("PR_AUC score = %f" % (score_pr_auc))
-        print("MSE score for train = %f" % (score_mse))
-        # These are per tag
-        try:
-            score_roc_auc_all = metrics.roc_auc_score(y_true, y_preds, average=None)
-            score_pr_auc_all = metrics.average_precision_score(y_true, y_preds, average=None)
-        except ValueError as e:
-            print("Soemthing wrong with evaluation")
-            print(e)
 
-        print("")
-        print("Per tag, roc_auc, pr_auc")
-        fixed_labels_list = list(np.array(labels_list)[~cols])
-        for i in range(len(fixed_labels_list)):
-            if cols[i]:  # Skip this tag if the count is <= 0
-                continue
-            print('%s \t\t\t %.4f \t%.4f' % (fixed_labels_list[i], score_roc_auc_all[i], score_pr_auc_all[i]))
+        if self.verbose:
+            print("")
+            print("Per tag, roc_auc, pr_auc")
+            fixed_labels_list = list(np.array(labels_list)[~cols])
+            for name, roc_auc, pr_auc in zip(fixed_labels_list, score_roc_auc_all, score_pr_auc_all):
+                print('%s \t\t\t %.4f \t%.4f' % (name, roc_auc, pr_auc))
 
         return score_roc_auc, score_pr_auc, score_roc_auc_all, score_pr_auc_all
 
     def _schedule(self, current_optimizer, drop_counter):
         if current_optimizer == 'adam' and drop_counter == 60:
-            self.load(os.path.join(self.model_save_path, 'best_model.pth'))
-            self.optimizer = torch.optim.SGD(self.model.parameters(), 0.001, momentum=0.9, weight_decay=0.0001, nesterov=True)
+            self._restore_best()
+            self.optimizer = self.get_optimizer(torch.optim.SGD, 0.001, momentum=0.9, weight_decay=0.0001, nesterov=True)
             current_optimizer = 'sgd_1'
             drop_counter = 0
             print('sgd 1e-3')
         # first drop
         if current_optimizer == 'sgd_1' and drop_counter == 20:
-            self.load(os.path.join(self.model_save_path, 'best_model.pth'))
+            self._restore_best()
             for pg in self.optimizer.param_groups:
                 pg['lr'] = 0.0001
             current_optimizer = 'sgd_2'
@@ -289,7 +443,7 @@ class Solver(object):
             print('sgd 1e-4')
         # second drop
         if current_optimizer == 'sgd_2' and drop_counter == 20:
-            self.load(os.path.join(self.model_save_path, 'best_model.pth'))
+            self._restore_best()
             for pg in self.optimizer.param_groups:
                 pg['lr'] = 0.00001
             current_optimizer = 'sgd_3'
@@ -298,42 +452,43 @@ class Solver(object):
 
     def test(self):
         start_t = time.time()
-        reconst_loss = nn.BCELoss()
         epoch = 0
 
         self.load(self.model_fn)
         self.model.eval()
         ctr = 0
-        prd_array = []  # prediction
-        gt_array = []   # ground truth
-        for x, y in self.data_loader:
-            ctr += 1
-
-            # variables to cuda
-            x = self.to_var(x)
-            y = self.to_var(y)
-
-            # predict
-            out = self.model(x)
-            loss = reconst_loss(out, y)
-
-            # print log
-            if (ctr) % self.log_step == 0:
-                print("[%s] Iter [%d/%d] test loss: %.4f Elapsed: %s" %
-                        (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                        ctr, len(self.data_loader), loss.item(),
-                        datetime.timedelta(seconds=time.time()-start_t)))
-
-            # append prediction
-            out = out.detach().cpu()
-            y = y.detach().cpu()
-            for prd in out:
-                prd_array.append(list(np.array(prd)))
-            for gt in y:
-                gt_array.append(list(np.array(gt)))
+        prd_array = torch.empty((len(self.data_loader.dataset), self.num_class), device=self.device)  # prediction
+        gt_array = torch.empty_like(prd_array)  # ground truth
+        offset = 0
+        with torch.inference_mode():
+            prefetcher = CUDAPrefetcher(self.data_loader, self.to_var, self.is_cuda)
+            x, y = prefetcher.next()
+            while x is not None:
+                ctr += 1
+
+                # predict
+                with torch.cuda.amp.autocast(enabled=self.is_cuda):
+                    out = self.model(x)
+                    loss = self.criterion(out, y)
+
+                # print log
+                if (ctr) % self.log_step == 0:
+                    print(self._test_fmt %
+                            (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                            ctr, len(self.data_loader), loss.item(),
+                            time.time()-start_t))
+
+                # append prediction
+                # logits stay on the device, copied to the host once after the loop
+                bs = out.shape[0]
+                prd_array[offset:offset+bs] = out.detach()
+                gt_array[offset:offset+bs] = y.detach()
+                offset += bs
+
+                x, y = prefetcher.next()
 
         # get auc
-        roc_auc, pr_auc, roc_auc_all, pr_auc_all = self.get_auc_turbo(prd_array, gt_array, self.tag_list)
+        roc_auc, pr_auc, roc_auc_all, pr_auc_all = self.get_auc_turbo(torch.sigmoid(prd_array[:offset].cpu()).numpy(), gt_array[:offset].cpu().numpy(), self.tag_list)
 
         # save aucs
         np.save(open(self.roc_auc_fn, 'wb'), roc_auc_all)